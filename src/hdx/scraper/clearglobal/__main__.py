@@ -67,25 +67,30 @@ def main(
                     save=save,
                     use_saved=use_saved,
                 )
-                pipeline = Pipeline(configuration, retriever, tempdir)
-                #
-                # Steps to generate dataset
-                #
-                countries = pipeline.get_locations(state_dict)
-                for _, countryinfo in progress_storing_folder(info, countries, "iso3"):
-                    dataset = pipeline.generate_dataset(countryinfo["iso3"])
-                    if dataset:
-                        dataset.update_from_yaml(
-                            script_dir_plus_file(
-                                join("config", "hdx_dataset_static.yaml"), main
-                            )
-                        )
-                        dataset.create_in_hdx(
-                            remove_additional_resources=True,
-                            match_resource_order=False,
-                            updated_by_script=_UPDATED_BY_SCRIPT,
-                            batch=info["batch"],
+                with Pipeline(configuration, retriever, tempdir) as pipeline:
+                    #
+                    # Steps to generate dataset
+                    #
+                    countries = pipeline.get_locations(state_dict)
+                    to_process = (
+                        countryinfo
+                        for _, countryinfo in progress_storing_folder(
+                            info, countries, "iso3"
                         )
+                    )
+                    for _, dataset in pipeline.generate_datasets(countries, to_process):
+                        if dataset:
+                            dataset.update_from_yaml(
+                                script_dir_plus_file(
+                                    join("config", "hdx_dataset_static.yaml"), main
+                                )
+                            )
+                            dataset.create_in_hdx(
+                                remove_additional_resources=True,
+                                match_resource_order=False,
+                                updated_by_script=_UPDATED_BY_SCRIPT,
+                                batch=info["batch"],
+                            )
             state.set(state_dict)
 
 
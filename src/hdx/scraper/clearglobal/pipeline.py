@@ -1,21 +1,41 @@
 #!/usr/bin/python
 """CLEAR Global scraper"""
 
+import csv
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
+from os.path import join
+from threading import local
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
 from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
 from hdx.data.dataset import Dataset
 from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
-from hdx.utilities.dateparse import default_date, default_enddate, parse_date
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
 from hdx.utilities.retriever import Retrieve
 from slugify import slugify
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=8192)
+def parse_date_cached(string: str) -> datetime:
+    # Dates are deduplicated per country before parsing, so this only saves
+    # parsing dates that recur across countries
+    return parse_date(string)
+
+
 class Pipeline:
     representivity_to_int = {
         "very_high": 0,
@@ -37,9 +57,41 @@ class Pipeline:
         self._retriever = retriever
         self._tempdir = tempdir
         self._baseurl = self._configuration.get("base_url")
+        self._page_size = self._configuration["page_size"]
+        self._fields = ",".join(self._configuration["headers"])
+        concurrent_countries = self._configuration["concurrent_countries"]
+        self._lookahead = concurrent_countries
+        self._country_executor = ThreadPoolExecutor(max_workers=concurrent_countries)
+        self._executor = ThreadPoolExecutor(max_workers=3 * concurrent_countries)
+        self._thread_data = local()
+        self._downloaders = []
+
+    def __enter__(self) -> "Pipeline":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._country_executor.shutdown(cancel_futures=True)
+        self._executor.shutdown(cancel_futures=True)
+        for downloader in self._downloaders:
+            downloader.close()
+
+    def get_thread_retriever(self) -> Retrieve:
+        # Download holds the response of the last request so each worker thread
+        # gets its own downloader, kept open so that connections are reused
+        retriever = getattr(self._thread_data, "retriever", None)
+        if retriever is None:
+            downloader = Download()
+            self._downloaders.append(downloader)
+            retriever = self._retriever.clone(downloader)
+            self._thread_data.retriever = retriever
+        return retriever
 
     def get_locations(self, state: Dict):
         url = f"{self._baseurl}locations"
+        # Not paged, so kept above the number of countries
         parameters = {
             "page_size": 500,
             "conds": '[["location_level", "=", 0]]',
@@ -56,49 +108,90 @@ class Pipeline:
                 locations.append({"iso3": countryiso3})
         return locations
 
-    def get_pages(self, countryiso3: str, aggregation: int) -> List:
-        all_data = []
+    def get_pages(
+        self,
+        countryiso3: str,
+        aggregation: int,
+        retriever: Optional[Retrieve] = None,
+    ) -> List:
+        if retriever is None:
+            retriever = self._retriever
+        pages = []
         url = f"{self._baseurl}location/{countryiso3}"
         page = 0
-        headers = ",".join(self._configuration["headers"])
+        parameters = {
+            "aggregation": aggregation,
+            "page_size": self._page_size,
+            "page": page,
+            "fields": self._fields,
+        }
         while True:
-            parameters = {
-                "aggregation": aggregation,
-                "page_size": 500,
-                "page": page,
-                "fields": headers,
-            }
+            parameters["page"] = page
             filename = f"location_{countryiso3}_adm{aggregation}_{page}.json"
-            json = self._retriever.download_json(
+            json = retriever.download_json(
                 url, filename=filename, parameters=parameters
             )
             data = json["data"]
-            all_data.extend(data)
-            if len(data) != 500 or len(data) == 0:
-                return all_data
+            pages.append(data)
+            if len(data) < self._page_size:
+                return pages
             page += 1
 
+    def get_pages_concurrently(self, countryiso3: str) -> List:
+        def get_aggregation_pages(aggregation: int) -> List:
+            retriever = self.get_thread_retriever()
+            return self.get_pages(countryiso3, aggregation, retriever)
+
+        return list(self._executor.map(get_aggregation_pages, range(0, 3)))
+
+    def generate_resource(
+        self, dataset: Dataset, filename: str, rows: Iterator[Dict], resourcedata: Dict
+    ) -> None:
+        # Written directly rather than with Dataset.generate_resource which
+        # holds all rows in memory and writes them through frictionless
+        headers = self._configuration["headers"]
+        filepath = join(self._tempdir, filename)
+        with open(
+            filepath, "w", buffering=1 << 20, encoding="utf-8", newline=""
+        ) as output:
+            writer = csv.writer(output)
+            writer.writerow(headers)
+            get_values = itemgetter(*headers)
+            if len(headers) == 1:
+                # itemgetter returns a bare value rather than a tuple for one key
+                writer.writerows((get_values(row),) for row in rows)
+            else:
+                writer.writerows(map(get_values, rows))
+        resource = Resource(resourcedata)
+        resource.set_format("csv")
+        resource.set_file_to_upload(filepath)
+        dataset.add_update_resource(resource)
+
     def add_resources(
         self, countryiso3: str, countryname: str, dataset: Dataset
     ) -> Optional[datetime]:
-        earliest_start_date = default_enddate
-        latest_end_date = default_date
+        published_dates = set()
         dataset_sources = set()
-        rep_rating_strs = set()
+        # Bit n is set if representivity rating n is present
+        rep_ratings_mask = 0
         has_resources = False
 
-        for aggregation in range(0, 3):
-            data = self.get_pages(countryiso3, aggregation)
-            if not data:
+        def process_rows(pages: List) -> Iterator[Dict]:
+            nonlocal rep_ratings_mask
+            # Bound once to avoid attribute lookups for every row
+            add_source = dataset_sources.add
+            add_published_date = published_dates.add
+            get_rep_rating_int = self.representivity_to_int.__getitem__
+            for row in chain.from_iterable(pages):
+                add_source(row["source"])
+                add_published_date(row["datetime_published"])
+                rep_rating_int = get_rep_rating_int(row["representivity_rating"])
+                rep_ratings_mask |= 1 << rep_rating_int
+                yield row
+
+        for aggregation, pages in enumerate(self.get_pages_concurrently(countryiso3)):
+            if not pages[0]:
                 continue
-            for row in data:
-                dataset_sources.add(row["source"])
-                published = parse_date(row["datetime_published"])
-                if published < earliest_start_date:
-                    earliest_start_date = published
-                if published > latest_end_date:
-                    latest_end_date = published
-                rep_rating_strs.add(row["representivity_rating"])
             filename = f"clearglobal_language_use_{countryiso3}_admin{aggregation}.csv"
             description = [f"Languages used in {countryname}"]
             if aggregation != 0:
@@ -111,28 +204,21 @@ class Pipeline:
                 "description": "".join(description),
                 "p_coded": pcoded,
             }
-            dataset.generate_resource(
-                self._tempdir,
-                filename,
-                data,
-                resourcedata,
-                headers=self._configuration["headers"],
-            )
+            self.generate_resource(dataset, filename, process_rows(pages), resourcedata)
             has_resources = True
         if not has_resources:
             return None
 
-        dataset.set_time_period(earliest_start_date, latest_end_date)
-        no_rep_ratings = len(rep_rating_strs)
-        if no_rep_ratings == 0:
+        # Dates are not in a sortable format so only the distinct ones are parsed
+        dates = [parse_date_cached(x) for x in published_dates]
+        dataset.set_time_period(min(dates), max(dates))
+        if rep_ratings_mask == 0:
             logger.error("No representivity rating, skipping")
             return None
-        rep_rating_ints = []
-        for rep_rating_str in rep_rating_strs:
-            rep_rating_ints.append(self.representivity_to_int[rep_rating_str])
         methodology = []
-        for rep_rating_int in sorted(rep_rating_ints):
-            methodology.append(self.representivity_mapping[rep_rating_int])
+        for rep_rating_int in sorted(self.representivity_mapping):
+            if rep_ratings_mask >> rep_rating_int & 1:
+                methodology.append(self.representivity_mapping[rep_rating_int])
         methodology_str = "; ".join(methodology)
         if methodology_str == "Census":
             dataset["methodology"] = "Census"
@@ -165,8 +251,46 @@ class Pipeline:
 
         self.add_resources(countryiso3, countryname, dataset)
         dataset.add_tag("languages")
-        dataset.set_subnational(True)
         dataset.preview_off()
-        viz_url = self._configuration["viz_url"].format(countryname=countryname)
-        dataset.set_custom_viz(viz_url.replace(" ", "%20"))
+        viz_url = self._configuration["viz_url"].format(countryname=quote(countryname))
+        dataset.set_custom_viz(viz_url)
         return dataset
+
+    @staticmethod
+    def load_caches() -> None:
+        # These class level caches are loaded on first use and filled in place,
+        # so they must be populated before generate_dataset runs in threads
+        Country.countriesdata()
+        Locations.validlocations()
+        Resource.read_formats_mappings()
+        Vocabulary.read_tags_mappings()
+        Vocabulary.get_approved_vocabulary()
+
+    def generate_datasets(
+        self, countries: List[Dict], to_process: Optional[Iterable[Dict]] = None
+    ) -> Iterator[Tuple[Dict, Optional[Dataset]]]:
+        # to_process must yield a contiguous run of countries (as
+        # progress_storing_folder does) and is only advanced when the next
+        # dataset is wanted. Datasets for the countries after it are generated
+        # ahead in the thread pool, up to concurrent_countries at a time.
+        if to_process is None:
+            to_process = countries
+        self.load_caches()
+        futures = deque()
+        next_index = None
+        for countryinfo in to_process:
+            if next_index is None:
+                next_index = countries.index(countryinfo)
+            while next_index < len(countries) and len(futures) < self._lookahead:
+                countryiso3 = countries[next_index]["iso3"]
+                future = self._country_executor.submit(
+                    self.generate_dataset, countryiso3
+                )
+                futures.append((countryiso3, future))
+                next_index += 1
+            countryiso3, future = futures.popleft()
+            if countryiso3 != countryinfo["iso3"]:
+                raise ValueError(
+                    f"Expected {countryiso3} but got {countryinfo['iso3']}!"
+                )
+            yield countryinfo, future.result()
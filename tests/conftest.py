@@ -34,7 +34,11 @@ def configuration(config_dir):
     # Change locations below to match those needed in tests
     Locations.set_validlocations(
         [
+            {"name": "ago", "title": "Angola"},
+            {"name": "arm", "title": "Armenia"},
+            {"name": "bdi", "title": "Burundi"},
             {"name": "ben", "title": "Benin"},
+            {"name": "bfa", "title": "Burkina Faso"},
         ]
     )
     Country.countriesdata(False)